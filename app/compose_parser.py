@@ -1,10 +1,28 @@
+import os
 import re
 import logging
+from functools import lru_cache
 from pathlib import Path
-from typing import Set
+from typing import FrozenSet, Set
 
 logger = logging.getLogger("deployer")
 
+# Regex para encontrar ${VAR_NAME} ou $VAR_NAME
+_ENV_VAR_RE = re.compile(r'\$\{([A-Z_][A-Z0-9_]*)\}|\$([A-Z_][A-Z0-9_]*)')
+
+
+@lru_cache(maxsize=256)
+def _extract_cached(path_str: str, mtime_ns: int) -> FrozenSet[str]:
+    """Cache por (path, mtime): o arquivo só é relido quando muda"""
+    with open(path_str, 'r') as f:
+        content = f.read()
+
+    matches = _ENV_VAR_RE.findall(content)
+
+    # Flatten tuplas e remover vazios
+    return frozenset(var for match in matches for var in match if var)
+
+
 def extract_env_vars_from_compose(compose_file: Path) -> Set[str]:
     """
     Lê docker-compose.yml e extrai todas as variáveis no formato ${VAR_NAME}
@@ -15,17 +33,8 @@ def extract_env_vars_from_compose(compose_file: Path) -> Set[str]:
     Retorna: {"GOOGLE_CLIENT_ID", "GOOGLE_CLIENT_SECRET", ...}
     """
     try:
-        with open(compose_file, 'r') as f:
-            content = f.read()
-        
-        # Regex para encontrar ${VAR_NAME} ou $VAR_NAME
-        pattern = r'\$\{([A-Z_][A-Z0-9_]*)\}|\$([A-Z_][A-Z0-9_]*)'
-        matches = re.findall(pattern, content)
-        
-        # Flatten tuplas e remover vazios
-        var_names = {var for match in matches for var in match if var}
-        
-        return var_names
+        mtime_ns = os.stat(compose_file).st_mtime_ns
+        return set(_extract_cached(str(compose_file), mtime_ns))
     except Exception as e:
         logger.error(f"Failed to parse compose file {compose_file}: {e}")
         return set()
@@ -1,20 +1,26 @@
 import asyncio
 import hashlib
 import hmac
-import json
 import logging
 import os
 import re
+import select
+import shutil
 import subprocess
 import time
+import uuid
 from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 from pathlib import Path
 from threading import Lock
 from typing import Any, Dict, List, Optional
 
 from fastapi import FastAPI, HTTPException, Request, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
+import orjson
+import redis.asyncio as redis
 
 from app.vault_client import VaultClient
 from app.compose_parser import extract_env_vars_from_compose
@@ -22,12 +28,26 @@ from app.compose_parser import extract_env_vars_from_compose
 # Configuration defaults
 RATE_LIMIT_WINDOW_SECONDS = 60
 TAIL_LIMIT = 2000
+TRUNCATED_MARKER = b"... (output truncated)\n"
 
 STACK_NAME_RE = re.compile(r"^[A-Za-z0-9_-]+$")
+SIGNATURE_RE = re.compile(r"^[0-9a-f]{64}$")
+SIGNATURE_COMPARE_KEY = os.urandom(32)
+SENSITIVE_KEYWORDS = ("secret", "token", "password", "passwd", "pwd", "key")
+# Alternação com classes [sS][eE]... gerada no import, evitando re.IGNORECASE
+# (case-folding por caractere) no regex que roda sobre toda saída de comando.
+_SENSITIVE_ALT = "|".join(
+    "".join(f"[{c}{c.upper()}]" for c in word) for word in SENSITIVE_KEYWORDS
+)
 SENSITIVE_RE = re.compile(
-    r"(?im)^\s*([^\s:=]*(?:secret|token|password|passwd|pwd|key)[^:=]*?)\s*[:=]\s*([^\n\r]+)"
+    r"(?m)^\s*([^\s:=]*(?:" + _SENSITIVE_ALT + r")[^:=]*?)\s*[:=]\s*([^\n\r]+)"
 )
 
+# Métodos já ligados: evitam lookup de global + atributo a cada requisição/step
+_stack_name_match = STACK_NAME_RE.match
+_signature_match = SIGNATURE_RE.match
+_sensitive_sub = SENSITIVE_RE.sub
+
 
 class Settings:
     def __init__(self) -> None:
@@ -38,17 +58,26 @@ class Settings:
         self.config_timeout = int(os.environ.get("CONFIG_TIMEOUT", "120"))
         self.pull_timeout = int(os.environ.get("PULL_TIMEOUT", "600"))
         self.up_timeout = int(os.environ.get("UP_TIMEOUT", "600"))
+        self.deploy_workers = int(os.environ.get("DEPLOY_WORKERS", "4"))
+        self.max_body_bytes = int(os.environ.get("MAX_BODY_BYTES", "65536"))
+        self.redis_url = os.environ.get("REDIS_URL", "")
+        self.redis_timeout = float(os.environ.get("REDIS_TIMEOUT", "0.5"))
+        self.docker_bin = shutil.which("docker") or "/usr/bin/docker"
         
         # Vault AppRole (opcional)
         self.vault_addr = os.environ.get("VAULT_ADDR", "")
         self.vault_role_id = os.environ.get("VAULT_ROLE_ID", "")
         self.vault_secret_id = os.environ.get("VAULT_SECRET_ID", "")
+        self.vault_token_cache = os.environ.get(
+            "VAULT_TOKEN_CACHE", "/dev/shm/deployer-vault-token.json"
+        )
 
         if not self.deploy_secret:
             raise SystemExit("DEPLOY_SECRET must be set (fail-closed).")
 
         if not self.stacks_root.exists():
             raise SystemExit(f"Stacks root not found: {self.stacks_root}")
+        self.stacks_root_resolved = self.stacks_root.resolve(strict=True)
 
 
 settings = Settings()
@@ -61,7 +90,7 @@ logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 def log_event(event: Dict[str, Any]) -> None:
     payload = {"ts": datetime.now(timezone.utc).isoformat(), **event}
-    logger.info(json.dumps(payload, default=str))
+    logger.info(orjson.dumps(payload, default=str).decode())
 
 
 # Inicializar VaultClient se as credenciais estiverem configuradas
@@ -70,43 +99,139 @@ if settings.vault_addr and settings.vault_role_id and settings.vault_secret_id:
     vault_client = VaultClient(
         addr=settings.vault_addr,
         role_id=settings.vault_role_id,
-        secret_id=settings.vault_secret_id
+        secret_id=settings.vault_secret_id,
+        token_cache_path=settings.vault_token_cache,
     )
     log_event({"event": "vault_client_initialized", "addr": settings.vault_addr})
 else:
     log_event({"event": "vault_client_disabled", "reason": "missing_credentials"})
 
 
-# Rate limiter
-request_buckets: Dict[str, deque] = defaultdict(deque)
-rate_limit_lock = Lock()
+# Pool dedicado para os comandos docker compose dos deploys
+deploy_executor = ThreadPoolExecutor(
+    max_workers=settings.deploy_workers, thread_name_prefix="deploy"
+)
 
 
-app = FastAPI(title="Deployer", version="1.0.0")
+# Rate limiter
+# Janela deslizante em sorted set: remove entradas antigas, conta e registra
+# a requisição atual numa única operação atômica no Redis.
+RATE_LIMIT_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', key, '-inf', '(' .. (now - window))
+if redis.call('ZCARD', key) >= limit then
+  return 0
+end
+redis.call('ZADD', key, now, ARGV[4])
+redis.call('EXPIRE', key, window)
+return 1
+"""
+
+# Usa Redis se REDIS_URL estiver configurado (compartilhado entre workers);
+# caso contrário, cai no limiter em memória do processo.
+redis_client: Optional[redis.Redis] = None
+rate_limit_script = None
+if settings.redis_url:
+    # Timeouts curtos: Redis travado vira RedisError e cai no limiter em memória
+    redis_client = redis.from_url(
+        settings.redis_url,
+        socket_timeout=settings.redis_timeout,
+        socket_connect_timeout=settings.redis_timeout,
+    )
+    rate_limit_script = redis_client.register_script(RATE_LIMIT_LUA)
+    log_event({"event": "rate_limiter_backend", "backend": "redis"})
+else:
+    log_event({"event": "rate_limiter_backend", "backend": "memory"})
 
+request_buckets: Dict[str, deque] = defaultdict(
+    lambda: deque(maxlen=settings.rate_limit_per_min)
+)
+rate_limit_lock = Lock()
 
-@app.middleware("http")
-async def rate_limiter(request: Request, call_next):
-    client_ip = request.client.host if request.client else "unknown"
-    now = time.time()
+
+def allow_request_local(client_ip: str) -> bool:
+    now = time.monotonic()
     with rate_limit_lock:
         bucket = request_buckets[client_ip]
         window_start = now - RATE_LIMIT_WINDOW_SECONDS
         while bucket and bucket[0] < window_start:
             bucket.popleft()
         if len(bucket) >= settings.rate_limit_per_min:
-            return JSONResponse(
-                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                content={"detail": "rate limit exceeded"},
-            )
+            return False
         bucket.append(now)
+        return True
+
+
+async def allow_request_redis(client_ip: str) -> bool:
+    # Relógio de parede: os timestamps são comparados entre processos
+    now = time.time()
+    allowed = await rate_limit_script(
+        keys=[f"deployer:ratelimit:{client_ip}"],
+        args=[now, RATE_LIMIT_WINDOW_SECONDS, settings.rate_limit_per_min, uuid.uuid4().hex],
+    )
+    return bool(allowed)
+
+
+def reap_request_buckets(now: float) -> None:
+    """Remove IPs sem requisições dentro da janela para o dict não crescer sem limite"""
+    window_start = now - RATE_LIMIT_WINDOW_SECONDS
+    with rate_limit_lock:
+        stale = [ip for ip, bucket in request_buckets.items() if not bucket or bucket[-1] < window_start]
+        for ip in stale:
+            del request_buckets[ip]
+
+
+async def reap_request_buckets_loop() -> None:
+    while True:
+        await asyncio.sleep(RATE_LIMIT_WINDOW_SECONDS)
+        reap_request_buckets(time.monotonic())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    reaper = asyncio.create_task(reap_request_buckets_loop())
+    yield
+    reaper.cancel()
+    deploy_executor.shutdown(wait=False, cancel_futures=True)
+    if redis_client is not None:
+        await redis_client.aclose()
+
+
+app = FastAPI(
+    title="Deployer",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+
+@app.middleware("http")
+async def rate_limiter(request: Request, call_next):
+    client_ip = request.client.host if request.client else "unknown"
+    if rate_limit_script is not None:
+        try:
+            allowed = await allow_request_redis(client_ip)
+        except redis.RedisError as e:
+            log_event({"event": "rate_limiter_redis_failed", "error": str(e)})
+            allowed = allow_request_local(client_ip)
+    else:
+        allowed = allow_request_local(client_ip)
+
+    if not allowed:
+        return ORJSONResponse(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            content={"detail": "rate limit exceeded"},
+        )
 
     response = await call_next(request)
     return response
 
 
 def validate_stack_name(name: str) -> str:
-    if not STACK_NAME_RE.match(name):
+    if not _stack_name_match(name):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="invalid stack name",
@@ -116,15 +241,11 @@ def validate_stack_name(name: str) -> str:
 
 def get_stack_path(stack: str) -> Path:
     stack_path = (settings.stacks_root / stack).resolve()
-    try:
-        settings_root = settings.stacks_root.resolve(strict=True)
-    except FileNotFoundError:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="stacks root missing",
-        )
+    settings_root = settings.stacks_root_resolved
 
-    if settings_root not in stack_path.parents and stack_path != settings_root:
+    try:
+        stack_path.relative_to(settings_root)
+    except ValueError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="invalid stack path",
@@ -147,14 +268,23 @@ def compute_signature(data: bytes) -> str:
     return hmac.new(settings.deploy_secret, data, hashlib.sha256).hexdigest()
 
 
+def signatures_match(expected: str, received: str) -> bool:
+    # Double HMAC: compara digests de uma chave aleatória do processo, então o
+    # tempo da comparação não depende dos bytes da assinatura recebida.
+    return hmac.compare_digest(
+        hmac.digest(SIGNATURE_COMPARE_KEY, expected.encode(), "sha256"),
+        hmac.digest(SIGNATURE_COMPARE_KEY, received.encode(), "sha256"),
+    )
+
+
 def verify_signature(signature_header: str, data: bytes) -> None:
     if not signature_header:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="missing signature",
         )
-    expected = compute_signature(data)
-    if not hmac.compare_digest(expected, signature_header.strip()):
+    signature = signature_header.strip()
+    if not _signature_match(signature) or not signatures_match(compute_signature(data), signature):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="invalid signature",
@@ -184,6 +314,69 @@ def infer_vault_paths(stack_name: str) -> List[str]:
     return [vault_path]
 
 
+def sanitize_output(text: str) -> str:
+    return _sensitive_sub(r"\1: ***", text)
+
+
+def sanitize_tail(raw: str) -> str:
+    # O corte em linha inteira fica em read_output_tail; aqui só sanitiza
+    return sanitize_output(raw)[-TAIL_LIMIT:]
+
+
+def read_output_tail(proc: subprocess.Popen, args: List[str], timeout: int) -> bytes:
+    """
+    Lê stdout do processo até EOF mantendo só os últimos bytes em memória.
+
+    Mata o processo e levanta TimeoutExpired se o timeout for atingido.
+    """
+    deadline = time.monotonic() + timeout
+    keep = TAIL_LIMIT * 2
+    buf = bytearray()
+    truncated = False
+    timed_out = False
+    fd = proc.stdout.fileno()
+    # poll em vez de select: select falha com fds >= FD_SETSIZE (1024)
+    poller = select.poll()
+    poller.register(fd, select.POLLIN)
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                timed_out = True
+                break
+            if not poller.poll(remaining * 1000):
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                try:
+                    proc.wait(timeout=max(deadline - time.monotonic(), 0))
+                except subprocess.TimeoutExpired:
+                    timed_out = True
+                break
+            buf += chunk
+            if len(buf) > keep:
+                del buf[:-keep]
+                truncated = True
+    finally:
+        proc.stdout.close()
+        # Qualquer saída antecipada (timeout, erro, cancelamento) não deixa o
+        # processo filho rodando nem sem reap
+        if proc.returncode is None:
+            proc.kill()
+            proc.wait()
+
+    if timed_out:
+        raise subprocess.TimeoutExpired(args, timeout)
+    if truncated:
+        # Descarta a primeira linha parcial: cortada no meio da chave, ela
+        # escaparia do SENSITIVE_RE (ancorado no início da linha)
+        newline = buf.find(b"\n")
+        del buf[:newline + 1 if newline >= 0 else len(buf)]
+        # Deixa explícito que houve corte (e não um tail vazio sem explicação)
+        buf[:0] = TRUNCATED_MARKER
+    return bytes(buf)
+
+
 def run_command(name: str, args: List[str], cwd: Path, timeout: int) -> Dict[str, Any]:
     return run_command_env(name, args, cwd, timeout, env=None)
 
@@ -191,27 +384,22 @@ def run_command(name: str, args: List[str], cwd: Path, timeout: int) -> Dict[str
 def run_command_env(
     name: str, args: List[str], cwd: Path, timeout: int, env: Optional[Dict[str, str]]
 ) -> Dict[str, Any]:
-    started = time.time()
+    started = time.monotonic()
     try:
-        proc_env = os.environ.copy()
-        if env:
-            proc_env.update(env)
+        # Sem env extra, env=None herda o ambiente do processo sem copiá-lo
+        proc_env = {**os.environ, **env} if env else None
 
-        proc = subprocess.run(
+        proc = subprocess.Popen(
             args,
             cwd=str(cwd),
-            capture_output=True,
-            text=True,
-            timeout=timeout,
-            check=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
             env=proc_env,
         )
-        duration_ms = int((time.time() - started) * 1000)
-        def sanitize_output(text: str) -> str:
-            return SENSITIVE_RE.sub(lambda m: f"{m.group(1)}: ***", text)
-
-        output_combined = sanitize_output((proc.stdout or "") + (proc.stderr or ""))
-        tail = output_combined[-TAIL_LIMIT:]
+        raw_tail = read_output_tail(proc, args, timeout)
+        duration_ms = int((time.monotonic() - started) * 1000)
+        tail = sanitize_tail(raw_tail.decode(errors="replace"))
         result = {
             "name": name,
             "ok": proc.returncode == 0,
@@ -231,7 +419,7 @@ def run_command_env(
         )
         return result
     except subprocess.TimeoutExpired as exc:
-        duration_ms = int((time.time() - started) * 1000)
+        duration_ms = int((time.monotonic() - started) * 1000)
         log_event(
             {
                 "event": "step_timeout",
@@ -249,7 +437,15 @@ def run_command_env(
         }
 
 
-def build_response(stack: str, steps: List[Dict[str, Any]], started_at: datetime) -> JSONResponse:
+async def run_deploy_step(
+    name: str, args: List[str], cwd: Path, timeout: int, env: Optional[Dict[str, str]]
+) -> Dict[str, Any]:
+    # Executor dedicado: pulls longos não ocupam o pool padrão do asyncio
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(deploy_executor, run_command_env, name, args, cwd, timeout, env)
+
+
+def build_response(stack: str, steps: List[Dict[str, Any]], started_at: datetime) -> ORJSONResponse:
     finished_at = datetime.now(timezone.utc)
     ok = all(step.get("ok") for step in steps)
     
@@ -270,10 +466,10 @@ def build_response(stack: str, steps: List[Dict[str, Any]], started_at: datetime
         "finished_at": finished_at.isoformat(),
     }
     status_code = status.HTTP_200_OK if ok else status.HTTP_500_INTERNAL_SERVER_ERROR
-    return JSONResponse(status_code=status_code, content=content)
+    return ORJSONResponse(status_code=status_code, content=content)
 
 
-async def perform_deploy(stack: str) -> JSONResponse:
+async def perform_deploy(stack: str) -> ORJSONResponse:
     validate_stack_name(stack)
     stack_path = get_stack_path(stack)
     docker_env = get_docker_env(stack_path)
@@ -352,13 +548,22 @@ async def perform_deploy(stack: str) -> JSONResponse:
             # Algumas stacks podem não precisar de secrets do Vault
 
     steps: List[Dict[str, Any]] = []
-    status_result = await asyncio.to_thread(
-        run_command_env,
-        "status",
-        ["docker", "compose", "ps", "--status=running", "--services"],
-        stack_path,
-        settings.status_timeout,
-        docker_env,
+    # status e config são só leitura e independentes: rodam em paralelo
+    status_result, config_step = await asyncio.gather(
+        run_deploy_step(
+            "status",
+            [settings.docker_bin, "compose", "ps", "--status=running", "--services"],
+            stack_path,
+            settings.status_timeout,
+            docker_env,
+        ),
+        run_deploy_step(
+            "config",
+            [settings.docker_bin, "compose", "config"],
+            stack_path,
+            settings.config_timeout,
+            docker_env,
+        ),
     )
     services = [line.strip() for line in status_result.get("tail", "").splitlines() if line.strip()]
     if status_result["ok"] and not services:
@@ -376,14 +581,6 @@ async def perform_deploy(stack: str) -> JSONResponse:
         )
         return build_response(stack, steps, started_at)
 
-    config_step = await asyncio.to_thread(
-        run_command_env,
-        "config",
-        ["docker", "compose", "config"],
-        stack_path,
-        settings.config_timeout,
-        docker_env,
-    )
     # Limitar output do config para evitar truncamento na resposta
     if config_step["ok"] and len(config_step.get("tail", "")) > 500:
         config_step["tail"] = config_step["tail"][:500] + "\n... (output truncated, config valid)"
@@ -391,10 +588,9 @@ async def perform_deploy(stack: str) -> JSONResponse:
 
     if steps[-1]["ok"]:
         steps.append(
-            await asyncio.to_thread(
-                run_command_env,
+            await run_deploy_step(
                 "pull",
-                ["docker", "compose", "pull"],
+                [settings.docker_bin, "compose", "pull"],
                 stack_path,
                 settings.pull_timeout,
                 docker_env,
@@ -403,10 +599,9 @@ async def perform_deploy(stack: str) -> JSONResponse:
 
     if steps[-1]["ok"]:
         steps.append(
-            await asyncio.to_thread(
-                run_command_env,
+            await run_deploy_step(
                 "up",
-                ["docker", "compose", "up", "-d", "--remove-orphans"],
+                [settings.docker_bin, "compose", "up", "-d", "--remove-orphans"],
                 stack_path,
                 settings.up_timeout,
                 docker_env,
@@ -428,9 +623,36 @@ async def health() -> Dict[str, str]:
     return {"status": "ok"}
 
 
+async def read_body_limited(request: Request) -> bytes:
+    """Lê o body com limite de tamanho, rejeitando antes de bufferizar tudo"""
+    too_large = HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail="request body too large",
+    )
+    content_length = request.headers.get("content-length")
+    if content_length is not None:
+        try:
+            declared = int(content_length)
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="invalid content-length",
+            )
+        if declared > settings.max_body_bytes:
+            raise too_large
+
+    # Sem Content-Length (ex.: chunked) o limite vale durante o streaming
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > settings.max_body_bytes:
+            raise too_large
+    return bytes(body)
+
+
 @app.post("/deploy/{stack}")
 async def deploy_stack(stack: str, request: Request):
-    body = await request.body()
+    body = await read_body_limited(request)
     raw_for_signature = body if body else stack.encode()
     verify_signature(request.headers.get("X-Signature", ""), raw_for_signature)
     return await perform_deploy(stack)
@@ -438,12 +660,12 @@ async def deploy_stack(stack: str, request: Request):
 
 @app.post("/deploy")
 async def deploy_body(request: Request):
-    body = await request.body()
+    body = await read_body_limited(request)
     verify_signature(request.headers.get("X-Signature", ""), body)
 
     try:
-        payload = json.loads(body.decode() or "{}")
-    except json.JSONDecodeError:
+        payload = orjson.loads(body or b"{}")
+    except orjson.JSONDecodeError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="invalid JSON payload",
@@ -461,7 +683,7 @@ async def deploy_body(request: Request):
 
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request: Request, exc: HTTPException):
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={"ok": False, "detail": exc.detail},
     )
@@ -470,7 +692,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
 @app.exception_handler(Exception)
 async def unhandled_exception_handler(request: Request, exc: Exception):
     log_event({"event": "error", "error": str(exc)})
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
         content={"ok": False, "detail": "internal server error"},
     )
@@ -1,18 +1,28 @@
 import hvac
+import json
 import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional
-from datetime import datetime, timedelta
 
 logger = logging.getLogger("deployer")
 
+# Máximo de leituras simultâneas no KV ao buscar vários paths
+MAX_PARALLEL_READS = 8
+
 class VaultClient:
-    def __init__(self, addr: str, role_id: str, secret_id: str):
+    def __init__(self, addr: str, role_id: str, secret_id: str, token_cache_path: str = ""):
         self.addr = addr
         self.role_id = role_id
         self.secret_id = secret_id
+        self.token_cache_path = token_cache_path
         self.client = hvac.Client(url=addr)
         self._token = None
-        self._token_expires = None
+        self._token_expires_monotonic = 0.0
+        self._auth_lock = threading.Lock()
         
     def authenticate(self) -> None:
         """Autentica via AppRole e armazena o token"""
@@ -22,37 +32,139 @@ class VaultClient:
                 secret_id=self.secret_id
             )
             self._token = response['auth']['client_token']
-            ttl = response['auth']['lease_duration']
-            self._token_expires = datetime.now() + timedelta(seconds=ttl - 60)
+            expires_in = response['auth']['lease_duration'] - 60
+            self._token_expires_monotonic = time.monotonic() + expires_in
             self.client.token = self._token
             logger.info(f"Vault authenticated successfully")
         except Exception as e:
             logger.error(f"Vault authentication failed: {e}")
             raise
-    
+        self._save_cached_token(time.time() + expires_in)
+
+    def _load_cached_token(self) -> bool:
+        """Reaproveita o token salvo por outro processo/restart, se ainda válido"""
+        if not self.token_cache_path:
+            return False
+        try:
+            with open(self.token_cache_path, 'r') as f:
+                cached = json.load(f)
+            if cached['addr'] != self.addr or cached['role_id'] != self.role_id:
+                return False
+            # Expiração salva em epoch (válida entre processos)
+            expires_in = cached['expires_at'] - time.time()
+            token = cached['token']
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        if expires_in <= 0:
+            return False
+        # O expires_at não cobre revogação/restart do Vault: confirma o token
+        self.client.token = token
+        if not self.client.is_authenticated():
+            logger.info("Cached Vault token rejected, discarding cache")
+            self._discard_cached_token()
+            self.client.token = self._token
+            return False
+        self._token = token
+        self._token_expires_monotonic = time.monotonic() + expires_in
+        logger.info("Vault token loaded from cache")
+        return True
+
+    def _discard_cached_token(self) -> None:
+        if not self.token_cache_path:
+            return
+        try:
+            os.unlink(self.token_cache_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove Vault token cache {self.token_cache_path}: {e}")
+
+    def _save_cached_token(self, expires_at: float) -> None:
+        """Grava token + expiração de forma atômica (arquivo temporário + rename)"""
+        if not self.token_cache_path:
+            return
+        cached = {
+            'addr': self.addr,
+            'role_id': self.role_id,
+            'token': self._token,
+            'expires_at': expires_at,
+        }
+        tmp_path = None
+        try:
+            # mkstemp: nome imprevisível, O_EXCL e modo 0600 (dir pode ser /dev/shm)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(self.token_cache_path) or ".",
+                prefix=".vault-token-",
+            )
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.token_cache_path)
+            tmp_path = None
+        except OSError as e:
+            logger.warning(f"Failed to cache Vault token at {self.token_cache_path}: {e}")
+        finally:
+            # Não deixar o token em um arquivo temporário órfão
+            if tmp_path:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
     def _ensure_authenticated(self) -> None:
         """Garante que está autenticado, renovando se necessário"""
-        if not self._token or (self._token_expires and datetime.now() >= self._token_expires):
+        with self._auth_lock:
+            if not self._token or time.monotonic() >= self._token_expires_monotonic:
+                if not self._load_cached_token():
+                    self.authenticate()
+
+    def _reauthenticate(self, rejected_token: Optional[str]) -> None:
+        """Descarta o token recusado pelo Vault e faz login de novo"""
+        with self._auth_lock:
+            # Outra thread pode já ter renovado o token
+            if self._token != rejected_token:
+                return
+            logger.info("Vault token rejected, re-authenticating")
+            self._discard_cached_token()
             self.authenticate()
-    
+
+    def _read_secret(self, path: str) -> Dict[str, str]:
+        response = self.client.secrets.kv.v2.read_secret_version(
+            path=path,
+            mount_point='kv'
+        )
+        return response['data']['data']
+
     def get_secrets(self, path: str) -> Dict[str, str]:
         """Busca secrets de um path no KV v2"""
         self._ensure_authenticated()
+        token = self._token
         try:
-            response = self.client.secrets.kv.v2.read_secret_version(
-                path=path,
-                mount_point='kv'
-            )
-            return response['data']['data']
+            try:
+                return self._read_secret(path)
+            except hvac.exceptions.Forbidden:
+                # 403 também vem de policy sem acesso ao path com token válido:
+                # só renova (e tenta uma vez) se o próprio token foi recusado
+                if self.client.is_authenticated():
+                    raise
+                self._reauthenticate(token)
+                return self._read_secret(path)
         except Exception as e:
             logger.warning(f"No secrets found at {path}: {e}")
             return {}
     
     def get_all_secrets_for_stack(self, stack_name: str, paths: List[str]) -> Dict[str, str]:
-        """Busca secrets de múltiplos paths e mescla em um único dict"""
+        """Busca secrets de múltiplos paths em paralelo e mescla em um único dict"""
+        # Autentica antes do fan-out para as threads não renovarem o token juntas
+        self._ensure_authenticated()
+        if len(paths) > 1:
+            with ThreadPoolExecutor(max_workers=min(len(paths), MAX_PARALLEL_READS)) as executor:
+                results = list(executor.map(self.get_secrets, paths))
+        else:
+            results = [self.get_secrets(path) for path in paths]
+
+        # Mescla na ordem dos paths: paths posteriores sobrescrevem os anteriores
         all_secrets = {}
-        for path in paths:
-            secrets = self.get_secrets(path)
+        for path, secrets in zip(paths, results):
             all_secrets.update(secrets)
             if secrets:
                 logger.info(f"[{stack_name}] Loaded {len(secrets)} secrets from {path}")